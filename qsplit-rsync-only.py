@@ -41,6 +41,7 @@ XXX escaping of wildcards and stuff.
 '''
 
 import argparse
+import heapq
 import time
 
 import qumulo.lib.auth as libauth
@@ -48,6 +49,8 @@ from qumulo.lib.request import Connection, RequestError
 import qumulo.rest.auth as auth
 import qumulo.rest.fs as fs
 
+from qsplit_rules import PruneRules, rule_type
+
 QUERY_ORDER_BY = {
     'capacity': 'total_blocks',
     'files':    'total_files'
@@ -89,6 +92,24 @@ class Directory(object):
         total_size = int(result.data[DIR_AGGREGATE_KEY[aggregate]])
         self.extra = total_size - self.total
 
+    def prune(self, rules, rpath):
+        ''' Drop entries excluded by the planning rules, returns their size '''
+        kept = []
+        pruned = 0
+        for dirent in self.entries:
+            relpath = (rpath + dirent.name).strip('/')
+            if rules.pruned(relpath, dirent.is_dir):
+                pruned += dirent.size
+                continue
+            if rules.truncated(relpath, dirent.is_dir):
+                # The directory is kept, but not its contents
+                pruned += dirent.size
+                dirent.size = 0
+            kept.append(dirent)
+        self.entries = kept
+        self.total -= pruned
+        return pruned
+
     def pop(self):
         dirent = self.entries.pop()
         self.total -= dirent.size
@@ -98,10 +119,10 @@ class Directory(object):
         return len(self.entries) == 0
 
 class Filter(object):
-    def __init__(self, size):
+    def __init__(self, size, rules=None):
         self.size = size
         self.free = self.size
-        self.entries = []
+        self.entries = list(rules or [])
         self.last_path = []
         self.included = set()
         self.excluded = set()
@@ -182,21 +203,187 @@ class RestConnection(object):
         return res
 
 
+class SampledResult(object):
+    def __init__(self, data):
+        self.data = data
+
+class CachedRest(object):
+    '''
+    Serves aggregates already read while sampling and passes any other
+    path on to rest. Counts the calls it had to pass on.
+    '''
+    def __init__(self, cache, rest):
+        self.cache = cache
+        self.rest = rest
+        self.calls = 0
+        self.misses = 0
+
+    def get_aggregates(self, path, aggregate):
+        self.calls += 1
+        if path in self.cache:
+            return self.cache[path]
+        self.misses += 1
+        return self.rest.get_aggregates(path, aggregate)
+
+class UnsampledRest(object):
+    '''
+    Stands in for the cluster when simulating a plan: a directory that was
+    not sampled comes back holding one indivisible item of its full size.
+    '''
+    def __init__(self, sizes):
+        self.sizes = sizes
+
+    def get_aggregates(self, path, aggregate):
+        size = self.sizes[path]
+        return SampledResult({
+            'files': [{'name': '*', 'type': 'FS_FILE_TYPE_FILE',
+                       ENTRY_AGGREGATE_KEY[aggregate]: size}],
+            DIR_AGGREGATE_KEY[aggregate]: size})
+
+class Tuner(object):
+    '''
+    Picks a bucket count and descent depth for the Partitioner.
+
+    A bounded crawl reads aggregates for the largest directories first. Each
+    candidate bucket count and descent depth is then planned by a real
+    Partitioner over that sample, with every unsampled directory treated as
+    one indivisible item. The fullest bucket of that plan gives the
+    imbalance, and its aggregates calls give the REST cost.
+    '''
+    def __init__(self, rest, aggregate, no_wildcards, max_buckets,
+                 target_imbalance, time_budget, probe_calls, rules):
+        self.rest = rest
+        self.aggregate = aggregate
+        self.no_wildcards = no_wildcards
+        self.max_buckets = max_buckets
+        self.target_imbalance = target_imbalance
+        self.time_budget = time_budget
+        self.probe_calls = probe_calls
+        self.rules = rules
+
+        self.start_path = None
+        self.cache = {}
+        self.unsampled = {}
+        self.deepest = 1
+        self.calls = 0
+        self.elapsed = 0.0
+        self.rows = None
+
+    def get_aggregates(self, path):
+        start = time.time()
+        res = self.rest.get_aggregates(path, self.aggregate)
+        self.elapsed += time.time() - start
+        self.calls += 1
+        self.cache[path] = res
+        return Directory(res, self.aggregate)
+
+    def add_entries(self, depth, qpath, folder, unread):
+        folder.prune(self.rules, qpath[len(self.start_path):])
+        for dirent in folder.entries:
+            self.deepest = max(self.deepest, depth)
+            if dirent.is_dir and dirent.size > 0:
+                self.unsampled[qpath + dirent.name] = dirent.size
+                heapq.heappush(unread, (-dirent.size, depth,
+                                        qpath + dirent.name))
+
+    def sample(self, start_path):
+        print("Sampling up to %d directories at %s" % (
+            self.probe_calls, start_path))
+
+        self.start_path = start_path
+        root = self.get_aggregates(start_path)
+
+        unread = []
+        self.add_entries(1, start_path, root, unread)
+        while unread and self.calls < self.probe_calls:
+            _, depth, qpath = heapq.heappop(unread)
+            del self.unsampled[qpath]
+            folder = self.get_aggregates(qpath)
+            self.add_entries(depth + 1, qpath, folder, unread)
+
+    def simulate(self, buckets, depth):
+        rest = CachedRest(self.cache, UnsampledRest(self.unsampled))
+        partitioner = Partitioner(rest, buckets, self.aggregate,
+                                  self.no_wildcards, depth, self.rules)
+        partitioner.start(self.start_path)
+
+        imbalance = 0.0
+        if partitioner.total_size > 0:
+            fullest = max(bucket.used() for bucket in partitioner.buckets)
+            imbalance = fullest * buckets / partitioner.total_size - 1
+        return max(imbalance, 0.0), rest.calls, rest.misses
+
+    def candidate_buckets(self):
+        candidates = []
+        buckets = 1
+        while buckets < self.max_buckets:
+            candidates.append(buckets)
+            buckets *= 2
+        candidates.append(self.max_buckets)
+        return candidates
+
+    def estimate(self, buckets):
+        ''' Shallowest depth meeting the target, else the most balanced '''
+        best = None
+        for depth in range(1, self.deepest + 1):
+            imbalance, calls, misses = self.simulate(buckets, depth)
+            if best is None or imbalance < best[1]:
+                best = (depth, imbalance, calls, misses)
+            if imbalance <= self.target_imbalance:
+                break
+
+        depth, imbalance, calls, misses = best
+        # Sampled directories are handed to the Partitioner, so only the
+        # remaining calls add to the time already spent sampling.
+        seconds = self.elapsed + misses * self.elapsed / max(self.calls, 1)
+        fits = imbalance <= self.target_imbalance and \
+            seconds <= self.time_budget
+        return (buckets, depth, imbalance, calls, seconds, fits)
+
+    def choose(self):
+        self.rows = [self.estimate(buckets)
+                     for buckets in self.candidate_buckets()]
+        fitting = [row for row in self.rows if row[5]]
+        if not fitting:
+            print("Warning: no bucket count met the %.1f%% imbalance target "
+                  "within %d seconds, falling back to a single bucket" % (
+                      100.0 * self.target_imbalance, self.time_budget))
+            return 1, 1
+        chosen = max(fitting, key=lambda row: row[0])
+        return chosen[0], chosen[1]
+
+    def print_table(self, chosen):
+        print("%7s %5s %9s %10s %12s" % (
+            "Buckets", "Depth", "Imbalance", "REST calls", "Est. seconds"))
+        for buckets, depth, imbalance, calls, seconds, fits in self.rows:
+            marker = ''
+            if buckets == chosen:
+                marker = '  <- chosen'
+            elif not fits:
+                marker = '  (misses target)'
+            print("%7d %5d %8.1f%% %10d %12.1f%s" % (
+                buckets, depth, 100.0 * imbalance, calls, seconds, marker))
+
+
 class Partitioner(object):
-    def __init__(self, rest, buckets, aggregate, no_wildcards):
+    def __init__(self, rest, buckets, aggregate, no_wildcards,
+                 descent_depth=None, rules=None):
         self.rest = rest
         self.num_buckets = buckets
         self.aggregate = aggregate
         self.no_wildcards = no_wildcards
+        self.descent_depth = descent_depth
+        self.rules = rules or PruneRules(None, None)
 
         self.handled = None
         self.path = None
         self.buckets = None
+        self.total_size = None
         self.max_bucket_size = None
 
     def create_bucket(self):
         assert len(self.buckets) < self.num_buckets
-        bucket = Filter(self.max_bucket_size)
+        bucket = Filter(self.max_bucket_size, self.rules.filter_rules())
         self.buckets.append(bucket)
         return bucket
 
@@ -206,13 +393,55 @@ class Partitioner(object):
     def current_bucket(self):
         return self.buckets[-1]
 
-    def start(self, start_path):
-        print("Gathering data at %s for %d buckets" % (
-            start_path, self.num_buckets))
+    def can_descend(self):
+        return self.descent_depth is None or \
+            len(self.path) < self.descent_depth
+
+    def prune(self, size):
+        ''' Take pruned items out of the total and shrink the current bucket,
+        and the buckets still to come, to match '''
+        self.total_size -= size
+        max_bucket_size = self.total_size / self.num_buckets
+        shrink = self.max_bucket_size - max_bucket_size
+        self.max_bucket_size = max_bucket_size
+        bucket = self.current_bucket()
+        bucket.size -= shrink
+        bucket.free -= shrink
+
+    def size_below(self, folder, qpath, rpath, known):
+        ''' Take items pruned deeper in the tree out of the sizes of the
+        folder's directories, crawling the ones a rule could match inside.
+        Returns the pruned size and, per directory, what was learned so a
+        later descent does not crawl it again. '''
+        pruned = 0
+        below = {}
+        for dirent in folder.entries:
+            if not dirent.is_dir or dirent.size == 0:
+                continue
+            if dirent.name in known:
+                below[dirent.name] = known[dirent.name]
+            elif self.rules.may_match_below((rpath + dirent.name).strip('/')):
+                below[dirent.name] = self.crawl(qpath + dirent.name,
+                                                rpath + dirent.name)
+            else:
+                continue
+            size = below[dirent.name][0]
+            dirent.size -= size
+            pruned += size
+        folder.total -= pruned
+        return pruned, below
+
+    def crawl(self, qpath, rpath):
+        res = self.rest.get_aggregates(qpath, self.aggregate)
+        folder = Directory(res, self.aggregate)
+        pruned = folder.prune(self.rules, rpath)
+        size, below = self.size_below(folder, qpath, rpath, {})
+        return pruned + size, below
 
+    def start(self, start_path):
         res = self.rest.get_aggregates(start_path, self.aggregate)
-        total_size = int(res.data[DIR_AGGREGATE_KEY[self.aggregate]])
-        self.max_bucket_size = total_size / self.num_buckets
+        self.total_size = int(res.data[DIR_AGGREGATE_KEY[self.aggregate]])
+        self.max_bucket_size = self.total_size / self.num_buckets
 
         self.handled = []
         self.path = []
@@ -221,12 +450,18 @@ class Partitioner(object):
         self.create_bucket()
         self.process_folder('/', start_path, res, '/')
 
-    def process_folder(self, name, qpath, res, rpath):
+    def process_folder(self, name, qpath, res, rpath, known=None):
 
         self.handled.append([])
         self.path.append(name)
 
+        # Anything pruned inside a folder reached from a crawled directory
+        # has already been taken out of the total
         folder = Directory(res, self.aggregate)
+        pruned = folder.prune(self.rules, rpath)
+        size, below = self.size_below(folder, qpath, rpath, known or {})
+        if known is None and pruned + size:
+            self.prune(pruned + size)
 
         while True:
             bucket = self.current_bucket()
@@ -239,16 +474,23 @@ class Partitioner(object):
                 bucket.include_remaining(self.path, self.handled, total)
                 break
 
+            # Without wildcards every entry is listed, so stop once the
+            # folder runs out, and let the last bucket take what is left
+            if folder.empty():
+                break
+
             dirent = folder.pop()
 
-            if dirent.size <= bucket.free:
+            if dirent.size <= bucket.free or self.on_last_bucket():
                 bucket.include_item(self.path, self.handled, dirent)
                 self.handled[-1].append(rpath + dirent.name)
-            elif dirent.is_dir:
+            elif dirent.is_dir and self.can_descend():
                 new_qpath = qpath + dirent.name
                 new_rpath = rpath + dirent.name
                 new_res = self.rest.get_aggregates(new_qpath, self.aggregate)
-                self.process_folder(dirent.name, new_qpath, new_res, new_rpath)
+                known = below.get(dirent.name, (0, {}))[1]
+                self.process_folder(dirent.name, new_qpath, new_res, new_rpath,
+                                    known)
                 self.handled[-1].append(rpath + dirent.name)
             else:
                 bucket.finish(self.path)
@@ -296,18 +538,62 @@ def main():
                         help='Basename for output filter files')
     parser.add_argument('--no-wildcards', action='store_true',
                         help='Do not use wildcards on filters')
+    parser.add_argument('--exclude', action='append', default=[],
+                        type=rule_type('-'),
+                        help='Skip paths matching this rsync-style pattern '
+                             'while planning and copying; may be repeated')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='Only plan and copy entries up to this many '
+                             'levels below start_path')
+    parser.add_argument('--auto', action='store_true',
+                        help='Pick bucket count and descent depth from a '
+                             'sampled crawl; --buckets is ignored')
+    parser.add_argument('--max-buckets', type=int, default=64,
+                        help='Largest bucket count --auto considers; '
+                             'defaults to 64')
+    parser.add_argument('--target-imbalance', type=float, default=0.05,
+                        help='Largest bucket overshoot --auto accepts, as a '
+                             'fraction of the average; defaults to 0.05')
+    parser.add_argument('--time-budget', type=float, default=600,
+                        help='Planning time --auto may spend, in seconds; '
+                             'defaults to 600')
+    parser.add_argument('--probe-calls', type=int, default=32,
+                        help='Directories --auto samples before choosing; '
+                             'defaults to 32')
 
     parser.add_argument("start_path", action="store",
                         help="Path on the cluster for file info")
 
     args = parser.parse_args()
 
+    if args.max_buckets < 1:
+        parser.error("--max-buckets must be at least 1")
+    if args.probe_calls < 1:
+        parser.error("--probe-calls must be at least 1")
+    if args.target_imbalance < 0:
+        parser.error("--target-imbalance must not be negative")
+
     connection = RestConnection(args.host, args.port,
                                 args.username, args.password,
                                 args.credentials_store)
 
-    partitioner = Partitioner(connection, args.buckets, args.aggregate,
-                              args.no_wildcards)
+    rules = PruneRules(args.exclude, args.max_depth)
+
+    buckets = args.buckets
+    descent_depth = None
+    rest = connection
+    if args.auto:
+        tuner = Tuner(connection, args.aggregate, args.no_wildcards,
+                      args.max_buckets, args.target_imbalance,
+                      args.time_budget, args.probe_calls, rules)
+        tuner.sample(args.start_path)
+        buckets, descent_depth = tuner.choose()
+        tuner.print_table(buckets)
+        rest = CachedRest(tuner.cache, connection)
+
+    print("Gathering data at %s for %d buckets" % (args.start_path, buckets))
+    partitioner = Partitioner(rest, buckets, args.aggregate,
+                              args.no_wildcards, descent_depth, rules)
     partitioner.start(args.start_path)
     partitioner.output_filters(args.filter_basename)
 
@@ -46,6 +46,31 @@ import qumulo.lib.request
 import qumulo.rest.fs as fs
 import qumulo.rest.snapshot as snap
 
+from qsplit_rules import PruneRules, rule_type
+
+# read_dir_aggregates listing size used to find pruned directories, matching
+# qsplit-rsync-only.py
+AGGREGATES_MAX_ENTRIES = 5000
+
+def rsync_sort_key(path, is_dir, separator='/'):
+    '''
+    rsync_sort_key builds a key that orders paths the way rsync walks a
+    file list: entries are grouped by parent directory, the files within a
+    directory come first (compared byte-wise, as rsync does), followed by
+    each subdirectory and everything beneath it.
+
+    Example:
+    ["a/b/1", "a/y", "a/b", "a/x"] sorts to ["a/x", "a/y", "a/b", "a/b/1"]
+    '''
+    components = [c for c in path.split(separator) if c != '']
+    key = []
+    for i, component in enumerate(components):
+        is_last = i == len(components) - 1
+        # files sort ahead of directories sharing the same parent
+        rank = 0 if (is_last and not is_dir) else 1
+        key.append((rank, component.encode('utf-8')))
+    return key
+
 class Bucket:
 
     def __init__(self, size, start_time):
@@ -89,7 +114,9 @@ class Bucket:
         if robocopy:
             path = path.replace('/','\\')
 
-        bucket_entry = { "path" : path, "size" : size }
+        bucket_entry = { "path" : path,
+                         "size" : size,
+                         "is_dir" : entry['type'] == "FS_FILE_TYPE_DIRECTORY" }
 
         # if we're creating robocopy buckets, don't add files just folders
         if robocopy and entry['type'] == "FS_FILE_TYPE_DIRECTORY" :
@@ -101,6 +128,15 @@ class Bucket:
         # decrement the size, regardless
         self.free_space -= size
 
+    def sort_entries(self, robocopy=False):
+        ''' order the bucket entries by parent directory, in rsync traversal
+            order, so each directory is opened once when the manifest is
+            replayed through --files-from. '''
+        separator = '\\' if robocopy else '/'
+        self.entries.sort(key=lambda entry: rsync_sort_key(entry['path'],
+                                                           entry['is_dir'],
+                                                           separator))
+
     def remaining_capacity(self):
         return self.free_space
 
@@ -156,6 +192,8 @@ class QumuloFilesCommand(object):
         self.robocopy = args.robocopy
         self.verbose = args.verbose
         self.snap = None
+        self.rules = PruneRules(args.rules, args.max_depth)
+        self.aggregate_entries = {}
         # add trailing slash if it doesn't exist
         self.start_path = re.sub("([^/])$", "\g<1>/", args.start_path)
 
@@ -241,6 +279,7 @@ class QumuloFilesCommand(object):
                                                     filename
                                                     )
                  )
+            bucket.sort_entries(self.robocopy)
             bucket.save(filename, len(self.start_path), self.robocopy)
 
             if self.verbose:
@@ -249,15 +288,70 @@ class QumuloFilesCommand(object):
 
             bucket_num += 1
 
+        if self.rules.active():
+            filename = "split_filter.txt"
+            print("Planning rules written to %s; pass --filter='. %s' to rsync" % (
+                                                    filename, filename))
+            with open(filename, 'w') as filter_file:
+                for line in self.rules.filter_rules():
+                    filter_file.write(line + '\n')
+
+    def entry_size(self, entry):
+        ''' size of a read_dir_aggregates child entry '''
+        sz = int(entry['capacity_usage'])
+        if self.agg_type == 'files':
+            sz = int(entry['num_files']) \
+                + int(entry['num_other_objects']) \
+                + int(entry['num_symlinks']) \
+                + int(entry['num_directories'])
+        return sz
+
+    def prune(self, size):
+        ''' take a pruned subtree out of the total and shrink the buckets
+            still being filled to match '''
+        self.total_size -= size
+        max_bucket_size = self.total_size / self.num_buckets
+        shrink = self.max_bucket_size - max_bucket_size
+        self.max_bucket_size = max_bucket_size
+        for bucket in self.buckets[self.bucket_index:]:
+            bucket.size -= shrink
+            bucket.free_space -= shrink
+
+    def pruned_size(self, path, name):
+        ''' size of a pruned child directory, from its parent's aggregates '''
+        entries = self.aggregate_entries.get(path, {})
+        if name not in entries:
+            print("Warning: %s%s is not in the aggregates listing of %s; "
+                  "its size stays in the bucket totals" % (path, name, path))
+            return 0
+        return self.entry_size(entries[name])
+
+    def crawl(self, path, entries):
+        ''' size of everything the rules prune inside the directory at path,
+            reading aggregates down every branch a rule could match. Also
+            returns what was learned per subdirectory, so a later descent
+            does not crawl it again. '''
+        pruned = 0
+        below = {}
+        for entry in entries:
+            relpath = path[len(self.start_path):] + entry['name']
+            is_dir = entry['type'] == "FS_FILE_TYPE_DIRECTORY"
+            if self.rules.pruned(relpath, is_dir) or self.rules.truncated(relpath, is_dir):
+                pruned += self.entry_size(entry)
+            elif is_dir and self.rules.may_match_below(relpath):
+                child = path + entry['name'] + "/"
+                below[entry['name']] = self.crawl(child, self.read_aggregates(child).data['files'])
+                pruned += below[entry['name']][0]
+        return pruned, below
+
     def get_directory_size(self, path):
-        try:
-            result = fs.read_dir_aggregates(self.connection, 
-                                            self.credentials,
-                                            path=path, 
-                                            snapshot=self.snap['id'] if self.snap is not None else None)
-        except qumulo.lib.request.RequestError as excpt:
-            print(sys.exc_info())
-            sys.exit(1)
+        result = self.read_aggregates(path)
+
+        # remember the children so they can be pruned without another
+        # aggregates request; dropped once the directory is handled
+        if self.rules.active():
+            self.aggregate_entries[path] = dict(
+                (entry['name'], entry) for entry in result.data['files'])
 
         sz = int(result.data['total_capacity'])
         if self.agg_type == 'files':
@@ -267,8 +361,24 @@ class QumuloFilesCommand(object):
                 + int(result.data['total_directories'])
         return sz
 
+    def read_aggregates(self, path):
+        # with planning rules, list enough children to size pruned ones
+        listing = {}
+        if self.rules.active():
+            listing['max_entries'] = AGGREGATES_MAX_ENTRIES
+        try:
+            result = fs.read_dir_aggregates(self.connection, 
+                                            self.credentials,
+                                            path=path, 
+                                            snapshot=self.snap['id'] if self.snap is not None else None,
+                                            **listing)
+        except qumulo.lib.request.RequestError as excpt:
+            print(sys.exc_info())
+            sys.exit(1)
+        return result
+
 
-    def process_folder(self, path):
+    def process_folder(self, path, known=None):
 
         try:
             response = fs.read_entire_directory(self.connection, 
@@ -283,13 +393,44 @@ class QumuloFilesCommand(object):
         for r in response:
             if self.verbose:
                 print("processing " + str(len(r.data['files'])) + " in path " + path)
-            self.process_folder_contents(r.data['files'], path)
+            self.process_folder_contents(r.data['files'], path, known)
             self.items_iterated_count += 1
 
+        self.aggregate_entries.pop(path, None)
+
 
-    def process_folder_contents(self, dir_contents, path):
+    def prune_folder_contents(self, dir_contents, path, accounted):
+        ''' drop the entries excluded by the planning rules before anything is
+            sized or added to a bucket. When the folder was crawled, their
+            sizes are already out of the totals. '''
+        if not self.rules.active():
+            return dir_contents
 
+        kept = []
         for entry in dir_contents:
+            relpath = path[len(self.start_path):] + entry['name']
+            is_dir = entry['type'] == "FS_FILE_TYPE_DIRECTORY"
+            if self.rules.pruned(relpath, is_dir):
+                if accounted:
+                    size = 0
+                elif is_dir:
+                    size = self.pruned_size(path, entry['name'])
+                elif self.agg_type == 'files':
+                    size = 1
+                else:
+                    size = int(entry['size'])
+                self.prune(size)
+                if self.verbose:
+                    print("Pruning " + path + entry['name'])
+            else:
+                kept.append(entry)
+        return kept
+
+    def process_folder_contents(self, dir_contents, path, known=None):
+
+        for entry in self.prune_folder_contents(dir_contents, path, known is not None):
+            relpath = path[len(self.start_path):] + entry['name']
+            below = None
             if self.items_iterated_count >0 and (self.items_iterated_count % 1000) == 0:
                 print("Processed %s items." % (self.items_iterated_count, ))
             size = 0
@@ -298,8 +439,22 @@ class QumuloFilesCommand(object):
                     size = 1
                 elif self.agg_type == 'capacity':
                     size = int(entry['size'])
+            elif self.rules.truncated(relpath, True):
+                # the directory is copied, but its contents are pruned
+                if known is None:
+                    self.prune(self.pruned_size(path, entry['name']))
             else:
                 size = self.get_directory_size(entry['path'])
+                if self.rules.may_match_below(relpath):
+                    # leave out whatever is pruned deeper inside, even if the
+                    # directory is added whole
+                    if known is not None and entry['name'] in known:
+                        pruned, below = known[entry['name']]
+                    else:
+                        entries = self.aggregate_entries[entry['path']].values()
+                        pruned, below = self.crawl(entry['path'], entries)
+                        self.prune(pruned)
+                    size -= pruned
 
             snap_dir = ""
             if self.snap is not None:
@@ -317,12 +472,14 @@ class QumuloFilesCommand(object):
                     new_path = path + entry['name'] + "/"
                     if self.verbose:
                         print("Calling process_folder with " + new_path + "... ")
-                    self.process_folder(new_path)
+                    self.process_folder(new_path, below)
                 else:
                     # It is a file that doesn't fit. Start a new bucket.
                     self.get_next_bucket()
                     print("Starting bucket " + str(self.bucket_index))
                     self.current_bucket().add(entry, path + snap_dir, size, self.robocopy)
+            if entry['type'] == "FS_FILE_TYPE_DIRECTORY":
+                self.aggregate_entries.pop(entry['path'], None)
             self.items_iterated_count += 1
  
 
@@ -341,9 +498,20 @@ def main():
     parser.add_argument("-r", "--robocopy", default=False, required=False, dest="robocopy", help="Generate Robocopy-friendly buckets", action="store_true")
     parser.add_argument("-a", "--aggregate_type", default='capacity', required=False, dest="agg_type", help="Split based on 'capacity' (default) or 'files'")
     parser.add_argument("-s", "--snapshot", default=None, required=False, dest="snapshot_id", help="Specify a specific snapshot by numeric id")
+    parser.add_argument("--exclude", dest="rules", action="append", type=rule_type('-'), help="Skip paths matching this rsync-style pattern while planning; may be repeated")
+    parser.add_argument("--include", dest="rules", action="append", type=rule_type('+'), help="Keep paths matching this rsync-style pattern even if a later --exclude matches them")
+    parser.add_argument("--max-depth", type=int, default=None, dest="max_depth", help="Only plan and copy entries up to this many levels below start_path")
     parser.add_argument("start_path", action="store", help="Path on the cluster for file info; Must be the last argument")
     args = parser.parse_args()
 
+    # snapshot manifests insert .snapshot/<name>/ into every path, which the
+    # filter rules written for rsync cannot follow
+    if args.snapshot_id is not None and (args.rules or args.max_depth is not None):
+        parser.error("--include, --exclude and --max-depth cannot be combined with --snapshot")
+    # robocopy manifests list whole folders and never see split_filter.txt
+    if args.robocopy and (args.rules or args.max_depth is not None):
+        parser.error("--include, --exclude and --max-depth cannot be combined with --robocopy")
+
     command = QumuloFilesCommand(args)
     print("Begin folder and file traversal.")
     command.process_folder(command.start_path)
@@ -0,0 +1,155 @@
+# Copyright (c) 2013 Qumulo, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+'''
+== Description:
+Planning-time include/exclude rules shared by qsplit.py and
+qsplit-rsync-only.py. Subtrees the rules prune are never crawled or sized,
+and the same rules are written out for rsync so the copy matches the plan.
+'''
+
+import argparse
+import re
+
+def glob_to_regex(pattern):
+    ''' translate an rsync-style glob: '*' and '?' stop at '/', '**' does not '''
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        c = pattern[i]
+        end = pattern.find(']', i + 2)
+        body = pattern[i+1:end]
+        negate = body.startswith('!')
+        if negate:
+            body = body[1:]
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and end != -1 and body:
+            # keep ranges, but nothing else in the class is special
+            body = ''.join('\\' + b if b in '\\^[]' else b for b in body)
+            regex += '[' + ('^' if negate else '') + body + ']'
+            i = end
+        else:
+            # an unclosed or empty class is literal text
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+def compile_pattern(pattern):
+    '''
+    compile one rsync-style pattern into (dir_only, regex) pairs, any of
+    which may match. A trailing '/***' matches the directory itself and
+    everything below it, as in rsync.
+    '''
+    matchers = []
+    if pattern.endswith('/***'):
+        base = pattern[:-len('/***')]
+        matchers.append((True, base))
+        matchers.append((False, base + '/**'))
+    else:
+        matchers.append((pattern.endswith('/'), pattern.rstrip('/')))
+
+    compiled = []
+    for dir_only, glob in matchers:
+        if glob.startswith('/'):
+            regex = '^' + glob_to_regex(glob[1:]) + '$'
+        else:
+            regex = '(^|/)' + glob_to_regex(glob) + '$'
+        compiled.append((dir_only, re.compile(regex)))
+    return compiled
+
+def rule_type(action):
+    ''' argparse type for --include/--exclude, rejecting bad patterns '''
+    def parse(pattern):
+        try:
+            compile_pattern(pattern)
+        except re.error as excpt:
+            raise argparse.ArgumentTypeError(
+                "invalid pattern %r: %s" % (pattern, excpt))
+        return (action, pattern)
+    return parse
+
+class PruneRules(object):
+    '''
+    Include/exclude globs and a depth limit, evaluated like rsync filter
+    rules: the first matching pattern wins. Paths are relative to the start
+    path without a leading slash. A pattern starting with '/' is anchored at
+    the start path, one ending in '/' only matches directories.
+    '''
+    def __init__(self, rules, max_depth):
+        self.rules = rules or []
+        self.max_depth = max_depth
+        self.compiled = []
+        for action, pattern in self.rules:
+            for dir_only, regex in compile_pattern(pattern):
+                self.compiled.append((action, dir_only, regex))
+
+    def active(self):
+        return len(self.rules) > 0 or self.max_depth is not None
+
+    def depth(self, relpath):
+        return relpath.count('/') + 1
+
+    def pruned(self, relpath, is_dir):
+        if self.max_depth is not None and self.depth(relpath) > self.max_depth:
+            return True
+        for action, dir_only, regex in self.compiled:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(relpath):
+                return action == '-'
+        return False
+
+    def truncated(self, relpath, is_dir):
+        ''' directories at the depth limit are kept, but not their contents '''
+        return bool(is_dir) and self.max_depth is not None and \
+            self.depth(relpath) == self.max_depth
+
+    def may_match_below(self, relpath):
+        '''
+        whether anything inside the directory at relpath could be pruned.
+        Unanchored and '**' excludes can match at any depth, so every
+        directory has to be looked into; anchored ones only below the
+        directories their leading components match.
+        '''
+        if self.max_depth is not None and self.depth(relpath) < self.max_depth:
+            return True
+        dirs = relpath.split('/')
+        for action, pattern in self.rules:
+            if action != '-':
+                continue
+            glob = pattern.rstrip('/')
+            if not glob.startswith('/') or '**' in glob:
+                return True
+            parts = glob[1:].split('/')
+            if len(parts) <= len(dirs):
+                continue
+            if all(re.match('^' + glob_to_regex(part) + '$', name)
+                   for part, name in zip(parts, dirs)):
+                return True
+        return False
+
+    def filter_rules(self):
+        ''' the rules as rsync filter lines; the depth limit goes first
+            because pruned() checks it before any pattern '''
+        lines = []
+        if self.max_depth is not None:
+            lines.append('- /' + '*/' * self.max_depth + '*')
+        for action, pattern in self.rules:
+            lines.append('%s %s' % (action, pattern))
+        return lines
@@ -0,0 +1,53 @@
+# Copyright (c) 2013 Qumulo, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from qsplit import Bucket, rsync_sort_key
+
+class RsyncSortKeyTests(unittest.TestCase):
+    ''' Manifest entries come out in rsync traversal order '''
+
+    def sort(self, paths, dirs=(), separator='/'):
+        return sorted(paths, key=lambda path: rsync_sort_key(
+            path, path in dirs, separator))
+
+    def test_files_before_subdirectories(self):
+        paths = ["a/b/1", "a/y", "a/b", "a/x"]
+        self.assertEqual(self.sort(paths, dirs=["a/b"]),
+                         ["a/x", "a/y", "a/b", "a/b/1"])
+
+    def test_byte_order(self):
+        self.assertEqual(self.sort(["a/x", "a/B", "a/_"]),
+                         ["a/B", "a/_", "a/x"])
+
+    def test_groups_by_parent(self):
+        paths = ["m/a/1", "m/z", "m/b/1", "m/a/2"]
+        self.assertEqual(self.sort(paths),
+                         ["m/z", "m/a/1", "m/a/2", "m/b/1"])
+
+    def test_robocopy_separator(self):
+        paths = ["m\\b\\1", "m\\a"]
+        self.assertEqual(self.sort(paths, separator='\\'),
+                         ["m\\a", "m\\b\\1"])
+
+    def test_bucket_sort_entries(self):
+        bucket = Bucket(100, None)
+        bucket.entries = [{"path": "m/d/f", "size": 1, "is_dir": False},
+                          {"path": "m/d", "size": 1, "is_dir": True},
+                          {"path": "m/g", "size": 1, "is_dir": False}]
+        bucket.sort_entries()
+        self.assertEqual([e["path"] for e in bucket.entries],
+                         ["m/g", "m/d", "m/d/f"])
@@ -0,0 +1,166 @@
+# Copyright (c) 2017 Qumulo, Inc. All rights reserved.
+#
+# NOTICE: All information and intellectual property contained herein is the
+# confidential property of Qumulo, Inc. Reproduction or dissemination of the
+# information or intellectual property contained herein is strictly forbidden,
+# unless separate prior written permission has been obtained from Qumulo, Inc.
+
+import importlib.util
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+SCRIPT = os.path.join(os.path.dirname(__file__), "..", "qsplit-rsync-only.py")
+spec = importlib.util.spec_from_file_location("qsplit_rsync_only", SCRIPT)
+qsplit_rsync_only = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(qsplit_rsync_only)
+
+class Result(object):
+    def __init__(self, data):
+        self.data = data
+
+def tree_size(tree):
+    return sum(tree_size(v) if isinstance(v, dict) else v
+               for v in tree.values())
+
+class FakeRest(object):
+    ''' Serves capacity aggregates for a nested dict of name -> size '''
+    def __init__(self, tree):
+        self.tree = tree
+        self.paths = []
+
+    def get_aggregates(self, path, aggregate):
+        self.paths.append(path)
+        folder = self.tree
+        for name in path.strip('/').split('/'):
+            if name:
+                folder = folder[name]
+        files = []
+        for name, value in folder.items():
+            is_dir = isinstance(value, dict)
+            files.append({
+                'name': name,
+                'type': 'FS_FILE_TYPE_DIRECTORY' if is_dir
+                        else 'FS_FILE_TYPE_FILE',
+                'capacity_usage': tree_size(value) if is_dir else value})
+        files.sort(key=lambda entry: -entry['capacity_usage'])
+        return Result({'files': files, 'total_capacity': tree_size(folder)})
+
+class PruneTests(unittest.TestCase):
+    ''' Pruned entries never reach a bucket and leave the totals '''
+
+    def test_directory_prune(self):
+        res = FakeRest({'a': {'keep': {'f': 5}, 'cache': {'g': 7},
+                              'x.tmp': 3, 'y': 2}}).get_aggregates(
+                                  '/a/', 'capacity')
+        folder = qsplit_rsync_only.Directory(res, 'capacity')
+        rules = qsplit_rsync_only.PruneRules([('-', 'cache/'),
+                                              ('-', '*.tmp')], 2)
+        self.assertEqual(folder.prune(rules, '/a/'), 7 + 3 + 5)
+        self.assertEqual(sorted((d.name, d.size) for d in folder.entries),
+                         [('keep/', 0), ('y', 2)])
+        self.assertEqual(folder.total, 2)
+
+    def test_partitioner_skips_pruned_subtrees(self):
+        rest = FakeRest({'tmp': {'big': 1000}, 'a': {'f': 60, 'g': 40},
+                         'b': 100})
+        rules = qsplit_rsync_only.PruneRules([('-', '/tmp/')], None)
+        partitioner = qsplit_rsync_only.Partitioner(rest, 2, 'capacity',
+                                                    False, None, rules)
+        partitioner.start('/')
+        self.assertNotIn('/tmp/', rest.paths)
+        self.assertEqual(partitioner.total_size, 200)
+        for bucket in partitioner.buckets:
+            self.assertEqual(bucket.entries[0], '- /tmp/')
+            self.assertEqual(bucket.size, 100)
+
+    def test_pruned_inside_directory_added_whole(self):
+        rest = FakeRest({'a': {'cache': {'big': 900}, 'f': 100},
+                         'b': {'g': 1000}})
+        rules = qsplit_rsync_only.PruneRules([('-', 'cache/')], None)
+        partitioner = qsplit_rsync_only.Partitioner(rest, 2, 'capacity',
+                                                    False, None, rules)
+        partitioner.start('/')
+        self.assertEqual(partitioner.total_size, 1100)
+        self.assertEqual([bucket.size for bucket in partitioner.buckets],
+                         [550, 550])
+
+    def test_crawled_directories_are_counted_once(self):
+        rest = FakeRest({'a': {'d': {'cache': {'big': 900}, 'x': 300,
+                                     'e': {'y': 200, 'cache': {'z': 50}}},
+                               'f': 100},
+                         'b': {'g': 300}})
+        rules = qsplit_rsync_only.PruneRules([('-', 'cache/')], None)
+        partitioner = qsplit_rsync_only.Partitioner(rest, 3, 'capacity',
+                                                    False, None, rules)
+        partitioner.start('/')
+        self.assertEqual(partitioner.total_size, 900)
+        self.assertEqual([bucket.used() for bucket in partitioner.buckets],
+                         [300, 300, 300])
+        self.assertNotIn('/a/d/cache/', rest.paths)
+
+class TunerTests(unittest.TestCase):
+    ''' --auto must not pick a plan that breaks the target imbalance '''
+
+    def plan(self, tree, target, probe_calls=32, no_wildcards=False):
+        rest = FakeRest(tree)
+        rules = qsplit_rsync_only.PruneRules(None, None)
+        tuner = qsplit_rsync_only.Tuner(rest, 'capacity', no_wildcards, 8,
+                                        target, 600, probe_calls, rules)
+        tuner.sample('/')
+        buckets, depth = tuner.choose()
+        sampled = len(rest.paths)
+
+        partitioner = qsplit_rsync_only.Partitioner(
+            qsplit_rsync_only.CachedRest(tuner.cache, rest), buckets,
+            'capacity', no_wildcards, depth, rules)
+        partitioner.start('/')
+        fullest = max(bucket.used() for bucket in partitioner.buckets)
+        imbalance = fullest * buckets / partitioner.total_size - 1
+        return tuner, buckets, imbalance, rest.paths[sampled:]
+
+    def test_last_bucket_carry_over(self):
+        tree = dict(('f%d' % i, 57) for i in range(7))
+        tuner, buckets, imbalance, _ = self.plan(tree, 0.6)
+        self.assertLessEqual(imbalance, 0.6)
+        rows = dict((row[0], row) for row in tuner.rows)
+        self.assertFalse(rows[4][5])
+        self.assertAlmostEqual(rows[4][2], 57 * 4 * 4 / 399.0 - 1)
+
+    def test_nested_tree_meets_target(self):
+        tree = {'a': {'b': dict(('f%d' % i, 10 + i) for i in range(12)),
+                      'x': 40, 'y': 35},
+                'c': dict(('g%d' % i, 20) for i in range(6)),
+                'z': 15}
+        _, buckets, imbalance, _ = self.plan(tree, 0.3)
+        self.assertGreater(buckets, 1)
+        self.assertLessEqual(imbalance, 0.3)
+
+    def test_no_wildcards_plan_matches_table(self):
+        tree = {'a': {'b': dict(('f%d' % i, 10 + i) for i in range(12)),
+                      'x': 40, 'y': 35},
+                'c': dict(('g%d' % i, 20) for i in range(6)),
+                'z': 15}
+        tuner, buckets, imbalance, _ = self.plan(tree, 0.3,
+                                                 no_wildcards=True)
+        row = [row for row in tuner.rows if row[0] == buckets][0]
+        self.assertAlmostEqual(row[2], imbalance)
+
+    def test_no_fit_falls_back_to_one_bucket(self):
+        tree = dict(('f%d' % i, 57) for i in range(7))
+        tuner, buckets, _, _ = self.plan(tree, -1.0)
+        self.assertEqual(buckets, 1)
+
+    def test_sampled_directories_are_not_read_again(self):
+        tree = {'a': {'b': {'f': 50, 'g': 50}, 'h': 30}, 'c': {'i': 40}}
+        _, _, _, replanned = self.plan(tree, 0.2)
+        self.assertEqual(replanned, [])
+
+    def test_unsampled_directories_are_indivisible(self):
+        tree = {'a': dict(('f%d' % i, 10) for i in range(10)), 'b': 10}
+        tuner, _, _, _ = self.plan(tree, 0.05, probe_calls=1)
+        imbalance, calls, misses = tuner.simulate(2, 2)
+        # a/ lands whole in the last bucket together with b
+        self.assertAlmostEqual(imbalance, 1.0)
+        self.assertEqual(misses, 1)
@@ -0,0 +1,114 @@
+# Copyright (c) 2013 Qumulo, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import argparse
+import os
+import re
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from qsplit_rules import PruneRules, glob_to_regex, rule_type
+
+class GlobTests(unittest.TestCase):
+    ''' rsync-style globs translate to anchored regular expressions '''
+
+    def matches(self, pattern, path):
+        return re.match('^' + glob_to_regex(pattern) + '$', path) is not None
+
+    def test_star_stops_at_slash(self):
+        self.assertTrue(self.matches('a*', 'abc'))
+        self.assertFalse(self.matches('a*', 'a/c'))
+        self.assertTrue(self.matches('a**', 'a/b/c'))
+        self.assertFalse(self.matches('?', '/'))
+
+    def test_leading_bang_negates(self):
+        self.assertTrue(self.matches('[!a]x', 'bx'))
+        self.assertFalse(self.matches('[!a]x', 'ax'))
+
+    def test_bang_inside_class_is_literal(self):
+        self.assertTrue(self.matches('[a!]x', '!x'))
+        self.assertTrue(self.matches('[a!]x', 'ax'))
+        self.assertFalse(self.matches('[a!]x', '^x'))
+
+    def test_class_is_escaped(self):
+        self.assertTrue(self.matches('[a^]', '^'))
+        self.assertTrue(self.matches('[\\]', '\\'))
+        self.assertFalse(self.matches('[\\]', 'a'))
+        self.assertTrue(self.matches('[a-c]', 'b'))
+
+    def test_unclosed_bracket_is_literal(self):
+        self.assertTrue(self.matches('a[b', 'a[b'))
+
+    def test_empty_negated_class_is_literal(self):
+        self.assertTrue(self.matches('[!]', '[!]'))
+        self.assertFalse(self.matches('[!]', 'a'))
+
+    def test_bad_pattern_is_an_argument_error(self):
+        self.assertEqual(rule_type('-')('[!]'), ('-', '[!]'))
+        self.assertRaises(argparse.ArgumentTypeError, rule_type('-'), '[z-a]')
+
+class PruneRulesTests(unittest.TestCase):
+    ''' The first matching rule wins, as in rsync '''
+
+    def test_first_match_wins(self):
+        rules = PruneRules([('+', 'keep.tmp'), ('-', '*.tmp')], None)
+        self.assertTrue(rules.pruned('a/x.tmp', False))
+        self.assertFalse(rules.pruned('a/keep.tmp', False))
+
+    def test_directory_only_and_anchored(self):
+        rules = PruneRules([('-', '.snapshot/'), ('-', '/scratch/')], None)
+        self.assertTrue(rules.pruned('a/.snapshot', True))
+        self.assertFalse(rules.pruned('a/.snapshot', False))
+        self.assertTrue(rules.pruned('scratch', True))
+        self.assertFalse(rules.pruned('a/scratch', True))
+
+    def test_max_depth(self):
+        rules = PruneRules(None, 2)
+        self.assertTrue(rules.active())
+        self.assertFalse(rules.pruned('a/b', True))
+        self.assertTrue(rules.truncated('a/b', True))
+        self.assertFalse(rules.truncated('a/b', False))
+        self.assertTrue(rules.pruned('a/b/c', False))
+
+    def test_max_depth_beats_include(self):
+        rules = PruneRules([('+', '*.txt')], 1)
+        self.assertTrue(rules.pruned('a/x.txt', False))
+        self.assertEqual(rules.filter_rules(), ['- /*/*', '+ *.txt'])
+
+    def test_triple_star_matches_directory_and_contents(self):
+        rules = PruneRules([('-', 'cache/***')], None)
+        self.assertTrue(rules.pruned('cache', True))
+        self.assertTrue(rules.pruned('a/cache', True))
+        self.assertFalse(rules.pruned('cache', False))
+        self.assertTrue(rules.pruned('a/cache/x', False))
+
+    def test_may_match_below(self):
+        self.assertTrue(PruneRules([('-', 'cache/')], None)
+                        .may_match_below('a/b'))
+        self.assertFalse(PruneRules([('+', 'keep')], None)
+                         .may_match_below('a'))
+        anchored = PruneRules([('-', '/a/*/tmp')], None)
+        self.assertTrue(anchored.may_match_below('a'))
+        self.assertTrue(anchored.may_match_below('a/b'))
+        self.assertFalse(anchored.may_match_below('a/b/tmp'))
+        self.assertFalse(anchored.may_match_below('x'))
+        self.assertTrue(PruneRules([('-', '/a/**/tmp')], None)
+                        .may_match_below('x'))
+        depth = PruneRules(None, 2)
+        self.assertTrue(depth.may_match_below('a'))
+        self.assertFalse(depth.may_match_below('a/b'))
+
+    def test_inactive(self):
+        rules = PruneRules(None, None)
+        self.assertFalse(rules.active())
+        self.assertEqual(rules.filter_rules(), [])